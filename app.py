@@ -1,12 +1,53 @@
+import atexit
+import base64
+import hashlib
+import hmac
+import logging
+import logging.handlers
 import os
+import queue
 import re
+import threading
+import time
+import concurrent.futures
+from concurrent.futures import Future, ThreadPoolExecutor
+import orjson
+import redis
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from cachetools import TTLCache
 from flask import Flask, request, jsonify
 
 app = Flask(__name__)
 
+# ---------------- LOGGING ----------------
+# Request threads only enqueue records; a listener thread writes to stderr
+_log_queue = queue.Queue(-1)
+_log_listener = logging.handlers.QueueListener(
+    _log_queue,
+    logging.StreamHandler()
+)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+
+logger = logging.getLogger("imogi")
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+logger.propagate = False
+
 # ---------------- ENV ----------------
 SLACK_BOT_TOKEN = os.getenv("SLACK_BOT_TOKEN")
+# Optional user token with search:read (bot tokens can't call search.messages)
+SLACK_USER_TOKEN = os.getenv("SLACK_USER_TOKEN")
+# Shopify app's webhook signing secret; when set, unsigned requests get 401
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+if not SHOPIFY_WEBHOOK_SECRET:
+    logger.warning(
+        "⚠️ SHOPIFY_WEBHOOK_SECRET is not set; webhook signatures are NOT verified"
+    )
+# Optional; shares order tracking across Gunicorn workers / dynos
+REDIS_URL = os.getenv("REDIS_URL")
 
 # Slack channels where "ST.order #1234" may appear
 CHANNELS_TO_SEARCH = [
@@ -14,79 +55,361 @@ CHANNELS_TO_SEARCH = [
     "C0A068PHZMY"   # shopify-slack
 ]
 
-# In-memory tracking (resets on restart)
-order_tracking = {}
+# Shared Slack session (keep-alive + connection pooling across webhooks)
+SLACK = requests.Session()
+SLACK.headers.update({"Authorization": f"Bearer {SLACK_BOT_TOKEN}"})
+SLACK.mount("https://", HTTPAdapter(
+    pool_connections=4,
+    pool_maxsize=16,
+    # Short retries only: ignore Slack's Retry-After (often tens of seconds,
+    # past Shopify's 5 s timeout) and hand back the last response instead of
+    # raising, so a 429 still reads as "ok": false like before
+    max_retries=Retry(
+        total=2,
+        backoff_factor=0.2,
+        status_forcelist=[429, 500, 502, 503, 504],
+        respect_retry_after_header=False,
+        raise_on_status=False
+    )
+))
+
+# 🏷️ Emoji mappings (names WITHOUT :)
+PAYMENT_EMOJI = {
+    "pending": "hourglass_flowing_sand",
+    "authorized": "lock",
+    "paid": "white_check_mark",
+    "voided": "x"
+}
+
+FULFILLMENT_EMOJI = {
+    "unfulfilled": "mailbox_with_no_mail",
+    "fulfilled": "rocket"
+}
+
+# Background workers for Slack reactions (webhook returns without waiting)
+_EXEC = ThreadPoolExecutor(max_workers=8)
+
+# History fetches are on the webhook's critical path; own pool so they
+# never queue behind reactions
+_HISTORY_EXEC = ThreadPoolExecutor(max_workers=4)
+
+# In-memory tracking (resets on restart); bounded so old orders age out
+ORDER_TRACKING_MAX = 10_000
+ORDER_TRACKING_TTL = 7 * 24 * 3600
+order_tracking = TTLCache(maxsize=ORDER_TRACKING_MAX, ttl=ORDER_TRACKING_TTL)
+_tracking_lock = threading.Lock()
+
+# Shared tracking: hash "o:<order_number>" per order, "o:<order_number>:lock"
+# while one worker looks the order up in Slack
+TRACK_FIELDS = ("ts", "channel", "payment", "fulfillment")
+LOOKUP_LOCK_TTL = 30
+REDIS = redis.Redis.from_url(
+    REDIS_URL,
+    decode_responses=True,
+    socket_keepalive=True,
+    health_check_interval=30
+) if REDIS_URL else None
+
+# Atomic compare-and-update of one order's statuses across all workers.
+# KEYS[1] = "o:<order_number>"; ARGV = ttl, ts, channel, payment, fulfillment
+# Returns {ts, channel, <names of the status fields that changed>...}
+_UPDATE_TRACK_LUA = """
+redis.call('HSETNX', KEYS[1], 'ts', ARGV[2])
+redis.call('HSETNX', KEYS[1], 'channel', ARGV[3])
+local result = {redis.call('HGET', KEYS[1], 'ts'), redis.call('HGET', KEYS[1], 'channel')}
+local statuses = {payment = ARGV[4], fulfillment = ARGV[5]}
+for _, field in ipairs({'payment', 'fulfillment'}) do
+    local value = statuses[field]
+    if value ~= '' and redis.call('HGET', KEYS[1], field) ~= value then
+        redis.call('HSET', KEYS[1], field, value)
+        table.insert(result, field)
+    end
+end
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return result
+"""
+_update_track_script = REDIS.register_script(_UPDATE_TRACK_LUA) if REDIS else None
+
+# Slack lookups in progress, shared by concurrent webhooks: {order_number: Future}
+# Kept under Shopify's 5 s delivery timeout so a waiter's 503 is seen
+LOOKUP_WAIT = 4
+_inflight = {}
+_inflight_lock = threading.Lock()
+
+# Order reference in a Slack message, case-insensitive
+_ORDER_RE = re.compile(r"(?i)\bst\.order\s+#?(\d+)\b")
+
+# Short-lived cache of channel history: {channel: (fetched_at, {order_number: ts})}
+HISTORY_TTL = 45
+_history_cache = {}
+_history_lock = threading.Lock()
+
+# --------------------------------------------------
+# 🧾 JSON (orjson is much faster than resp.json() on history pages)
+# --------------------------------------------------
+def _json(resp):
+    return orjson.loads(resp.content)
+
 
 # --------------------------------------------------
 # 🔒 STRICT MATCH: ONLY "ST.order #1234"
 # --------------------------------------------------
-def is_new_order_message(text, order_number):
+def extract_order_number(text):
     if not text:
-        return False
-    match = re.search(r"\bst\.order\s+#?(\d+)\b", text.lower())
-    return bool(match and match.group(1) == order_number)
+        return None
+    match = _ORDER_RE.search(text)
+    return match.group(1) if match else None
+
+
+def is_new_order_message(text, order_number):
+    return extract_order_number(text) == order_number
 
 
 # --------------------------------------------------
-# 🔍 FIND ORIGINAL NEW ORDER SLACK MESSAGE
+# 📜 CHANNEL HISTORY INDEX (cached for HISTORY_TTL seconds)
 # --------------------------------------------------
-def find_new_order_message(order_number):
-    headers = {"Authorization": f"Bearer {SLACK_BOT_TOKEN}"}
+def cached_order_index(channel):
+    with _history_lock:
+        cached = _history_cache.get(channel)
+    if cached and time.monotonic() - cached[0] < HISTORY_TTL:
+        return cached[1]
+    return None
 
-    for channel in CHANNELS_TO_SEARCH:
-        resp = requests.get(
-            "https://slack.com/api/conversations.history",
-            headers=headers,
-            params={"channel": channel, "limit": 100},
+
+def fetch_order_index(channel):
+    resp = SLACK.get(
+        "https://slack.com/api/conversations.history",
+        params={"channel": channel, "limit": 100},
+        timeout=10
+    )
+
+    data = _json(resp)
+    if not data.get("ok"):
+        return {}
+
+    # Oldest message wins, same as scanning the history in reverse
+    index = {}
+    for msg in reversed(data.get("messages", [])):
+        if match := _ORDER_RE.search(msg.get("text") or ""):
+            index.setdefault(match.group(1), msg["ts"])
+
+    with _history_lock:
+        _history_cache[channel] = (time.monotonic(), index)
+
+    return index
+
+
+# --------------------------------------------------
+# 🔎 SLACK SEARCH (needs SLACK_USER_TOKEN)
+# --------------------------------------------------
+def search_new_order_message(order_number):
+    if not SLACK_USER_TOKEN:
+        return None, None
+
+    try:
+        resp = SLACK.get(
+            "https://slack.com/api/search.messages",
+            headers={"Authorization": f"Bearer {SLACK_USER_TOKEN}"},
+            params={
+                "query": f'"ST.order #{order_number}"',
+                "count": 5,
+                "sort": "timestamp",
+                "sort_dir": "asc"
+            },
             timeout=10
         )
+        data = _json(resp)
+    except (requests.RequestException, orjson.JSONDecodeError) as exc:
+        # Search is best-effort; the history scan still runs
+        logger.warning("⚠️ Slack search failed: %s", exc)
+        return None, None
+
+    if not data.get("ok"):
+        logger.warning("⚠️ Slack search failed: %s", data.get("error"))
+        return None, None
 
-        data = resp.json()
-        if not data.get("ok"):
-            continue
+    try:
+        matches = data["messages"]["matches"]
+    except (KeyError, TypeError):
+        matches = []
 
-        for msg in reversed(data.get("messages", [])):
-            if is_new_order_message(msg.get("text", ""), order_number):
-                return msg["ts"], channel
+    for channel in CHANNELS_TO_SEARCH:
+        for match in matches:
+            if (match.get("channel", {}).get("id") == channel
+                    and is_new_order_message(match.get("text"), order_number)):
+                return match["ts"], channel
 
     return None, None
 
 
 # --------------------------------------------------
-# 😀 ADD EMOJI REACTION
+# 🔍 FIND ORIGINAL NEW ORDER SLACK MESSAGE
 # --------------------------------------------------
-def add_reaction(channel, message_ts, emoji_name):
-    resp = requests.post(
-        "https://slack.com/api/reactions.add",
-        headers={"Authorization": f"Bearer {SLACK_BOT_TOKEN}"},
-        json={
-            "channel": channel,
-            "timestamp": message_ts,
-            "name": emoji_name   # emoji name WITHOUT :
-        },
-        timeout=10
+def find_new_order_message(order_number):
+    ts, channel = search_new_order_message(order_number)
+    if ts:
+        return ts, channel
+
+    # Fall back to scanning channel history (no search token, or the
+    # message isn't in Slack's search index yet)
+    for channel in CHANNELS_TO_SEARCH:
+        index = cached_order_index(channel)
+        if index and order_number in index:
+            return index[order_number], channel
+
+    # No fresh page has it (stale, or the order was posted after the
+    # page was fetched); refetch every channel in parallel
+    pending = {
+        ch: _HISTORY_EXEC.submit(fetch_order_index, ch)
+        for ch in CHANNELS_TO_SEARCH
+    }
+    deadline = time.monotonic() + LOOKUP_WAIT
+    for channel in CHANNELS_TO_SEARCH:
+        # raises concurrent.futures.TimeoutError if Slack is too slow
+        index = pending[channel].result(timeout=max(0, deadline - time.monotonic()))
+        if order_number in index:
+            return index[order_number], channel
+
+    return None, None
+
+
+# --------------------------------------------------
+# 🗂️ ORDER TRACKING STORE (Redis if configured, else in-memory)
+# --------------------------------------------------
+def load_track(order_number):
+    if REDIS is None:
+        with _tracking_lock:
+            return order_tracking.get(order_number)
+
+    data = REDIS.hgetall(f"o:{order_number}")
+    if not data:
+        return None
+    return {field: data.get(field) or None for field in TRACK_FIELDS}
+
+
+# Stores new statuses; returns (track, names of the fields that changed)
+def update_track(order_number, track, payment, fulfillment):
+    if REDIS is not None:
+        ts, channel, *changed = _update_track_script(
+            keys=[f"o:{order_number}"],
+            args=[ORDER_TRACKING_TTL, track["ts"], track["channel"],
+                  payment or "", fulfillment or ""]
+        )
+        return {"ts": ts, "channel": channel}, changed
+
+    with _tracking_lock:
+        # Another request may have stored or updated it meanwhile
+        track = order_tracking.get(order_number) or track
+        changed = []
+        if payment and payment != track["payment"]:
+            track["payment"] = payment
+            changed.append("payment")
+        if fulfillment and fulfillment != track["fulfillment"]:
+            track["fulfillment"] = fulfillment
+            changed.append("fulfillment")
+        order_tracking[order_number] = track
+
+    return track, changed
+
+
+def wait_for_tracked_message(order_number):
+    # Another worker holds the lookup lock; poll for the track it saves
+    deadline = time.monotonic() + LOOKUP_WAIT
+    while time.monotonic() < deadline:
+        time.sleep(0.2)
+        track = load_track(order_number)
+        if track:
+            return track["ts"], track["channel"]
+
+    raise concurrent.futures.TimeoutError(
+        f"lookup for order {order_number} still running"
     )
 
-    print("⬅️ Slack reaction response:", resp.json())
+
+def find_new_order_message_once(order_number):
+    if REDIS is None:
+        return find_new_order_message(order_number)
+
+    lock_key = f"o:{order_number}:lock"
+    if not REDIS.set(lock_key, 1, nx=True, ex=LOOKUP_LOCK_TTL):
+        return wait_for_tracked_message(order_number)
+
+    ts = None
+    try:
+        ts, channel = find_new_order_message(order_number)
+        return ts, channel
+    finally:
+        # Not found or Slack failed: let the next webhook try again right
+        # away; on success the lock just expires
+        if not ts:
+            REDIS.delete(lock_key)
 
 
 # --------------------------------------------------
-# 🏷️ EMOJI MAPPINGS
+# 🤝 ONE LOOKUP PER ORDER AT A TIME
 # --------------------------------------------------
-def payment_reaction(status):
-    return {
-        "pending": "hourglass_flowing_sand",
-        "authorized": "lock",
-        "paid": "white_check_mark",
-        "voided": "x"
-    }.get(status)
+def lookup_new_order_message(order_number):
+    with _inflight_lock:
+        fut = _inflight.get(order_number)
+        owner = fut is None
+        if owner:
+            fut = _inflight[order_number] = Future()
 
+    if not owner:
+        # Another webhook for this order is already asking Slack;
+        # raises concurrent.futures.TimeoutError after LOOKUP_WAIT
+        return fut.result(timeout=LOOKUP_WAIT)
 
-def fulfillment_reaction(status):
-    return {
-        "unfulfilled": "mailbox_with_no_mail",
-        "fulfilled": "rocket"
-    }.get(status)
+    try:
+        result = find_new_order_message_once(order_number)
+    except Exception as exc:
+        fut.set_exception(exc)
+        raise
+    else:
+        fut.set_result(result)
+        return result
+    finally:
+        with _inflight_lock:
+            _inflight.pop(order_number, None)
+
+
+# --------------------------------------------------
+# 😀 ADD EMOJI REACTION
+# --------------------------------------------------
+def add_reaction(channel, message_ts, emoji_name):
+    try:
+        resp = SLACK.post(
+            "https://slack.com/api/reactions.add",
+            data=orjson.dumps({
+                "channel": channel,
+                "timestamp": message_ts,
+                "name": emoji_name   # emoji name WITHOUT :
+            }),
+            headers={"Content-Type": "application/json; charset=utf-8"},
+            timeout=10
+        )
+        data = _json(resp)
+    except (requests.RequestException, orjson.JSONDecodeError) as exc:
+        # Runs on the executor, so nobody else would see this
+        logger.warning("⚠️ Slack reaction failed: %s %s", emoji_name, exc)
+        return
+
+    if data.get("ok"):
+        logger.info("⬅️ Slack reaction added: %s", emoji_name)
+    else:
+        logger.warning("⬅️ Slack reaction response: %s", data)
+
+
+# --------------------------------------------------
+# 🔏 SHOPIFY WEBHOOK SIGNATURE
+# --------------------------------------------------
+def is_valid_shopify_hmac(raw_body, signature):
+    if not SHOPIFY_WEBHOOK_SECRET:
+        return True
+    digest = base64.b64encode(
+        hmac.new(SHOPIFY_WEBHOOK_SECRET.encode(), raw_body, hashlib.sha256).digest()
+    )
+    return hmac.compare_digest(digest, signature.encode())
 
 
 # --------------------------------------------------
@@ -94,7 +417,16 @@ def fulfillment_reaction(status):
 # --------------------------------------------------
 @app.route("/webhook/shopify", methods=["POST"])
 def shopify_webhook():
-    data = request.get_json(force=True)
+    # Check the signature before parsing or doing any Slack work
+    raw = request.get_data(cache=False)
+    if not is_valid_shopify_hmac(raw, request.headers.get("X-Shopify-Hmac-Sha256", "")):
+        return jsonify({"error": "invalid signature"}), 401
+
+    try:
+        data = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return jsonify({"error": "invalid JSON"}), 400
+
     order = data.get("order", data)
 
     order_number = str(order.get("name", "")).replace("#", "").strip()
@@ -102,35 +434,45 @@ def shopify_webhook():
         return jsonify({"error": "order number missing"}), 400
 
     # Find Slack message once per order
-    if order_number not in order_tracking:
-        ts, channel = find_new_order_message(order_number)
+    track = load_track(order_number)
+
+    if track is None:
+        try:
+            ts, channel = lookup_new_order_message(order_number)
+        except concurrent.futures.TimeoutError:
+            # Slack (or another request's lookup) is still running; non-2xx
+            # so Shopify redelivers this payload instead of it being dropped
+            return jsonify({"ok": False, "error": "lookup in progress"}), 503
         if not ts:
             return jsonify({"ok": False}), 202
 
-        order_tracking[order_number] = {
+        track = {
             "ts": ts,
             "channel": channel,
             "payment": None,
             "fulfillment": None
         }
 
-    track = order_tracking[order_number]
+    payment = order.get("financial_status")
+    fulfillment = order.get("fulfillment_status")
+    track, changed = update_track(order_number, track, payment, fulfillment)
+
+    reactions = []
 
     # -------- PAYMENT STATUS --------
-    payment = order.get("financial_status")
-    if payment and payment != track["payment"]:
-        emoji = payment_reaction(payment)
+    if "payment" in changed:
+        emoji = PAYMENT_EMOJI.get(payment)
         if emoji:
-            add_reaction(track["channel"], track["ts"], emoji)
-        track["payment"] = payment
+            reactions.append(emoji)
 
     # -------- FULFILLMENT STATUS --------
-    fulfillment = order.get("fulfillment_status")
-    if fulfillment and fulfillment != track["fulfillment"]:
-        emoji = fulfillment_reaction(fulfillment)
+    if "fulfillment" in changed:
+        emoji = FULFILLMENT_EMOJI.get(fulfillment)
         if emoji:
-            add_reaction(track["channel"], track["ts"], emoji)
-        track["fulfillment"] = fulfillment
+            reactions.append(emoji)
+
+    for emoji in reactions:
+        _EXEC.submit(add_reaction, track["channel"], track["ts"], emoji)
 
     return jsonify({"ok": True}), 200
 
@@ -140,9 +482,16 @@ def shopify_webhook():
 # --------------------------------------------------
 @app.route("/health")
 def health():
+    if REDIS is not None:
+        return jsonify({"status": "ok", "tracking": "redis"})
+
+    with _tracking_lock:
+        tracked = len(order_tracking)
+
     return jsonify({
         "status": "ok",
-        "tracked_orders": len(order_tracking)
+        "tracking": "memory",
+        "tracked_orders": tracked
     })
 
 